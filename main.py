@@ -1,7 +1,11 @@
 import fitz  # PyMuPDF
 import sys
 import os
-import Levenshtein
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from rapidfuzz import process
+from rapidfuzz.distance import Levenshtein as RFL
 
 # escape codes for console output colors
 RED = "\033[91m"
@@ -17,79 +21,181 @@ MAX_PAGE_DISTANCE = 5
 # optionally stricter limit for fuzzy
 FUZZY_MAX_PAGE_DISTANCE = 5
 
-def find_best_fuzzy_match_in_pages(doc, text_to_find, threshold_ratio, base_allowance, page_indices):
+# annotation supported by this script (Text Markups), mapped to the page method creating them
+ADDERS = {
+    fitz.PDF_ANNOT_HIGHLIGHT: fitz.Page.add_highlight_annot,
+    fitz.PDF_ANNOT_UNDERLINE: fitz.Page.add_underline_annot,
+    fitz.PDF_ANNOT_SQUIGGLY: fitz.Page.add_squiggly_annot
+}
+
+# text extraction flags of the exact search, same as the page.search_for default
+# (notably joining words hyphenated at line ends)
+SEARCH_FLAGS = (
+    fitz.TEXT_DEHYPHENATE
+    | fitz.TEXT_PRESERVE_WHITESPACE
+    | fitz.TEXT_PRESERVE_LIGATURES
+    | fitz.TEXT_MEDIABOX_CLIP
+)
+
+# number of per-annotation log lines buffered before writing them to the console
+LOG_FLUSH_LINES = 50
+
+# per-process state of the matching workers, set once by _init_match_worker
+_worker = {}
+
+def get_page(doc, page_idx, loaded_pages):
     """
-    Searches a subset of pages in the document for the "best" fuzzy match.
+    Returns a page of the document, loading it only on first access.
     
     Args:
-        doc (fitz.Document): The document to search.
+        doc (fitz.Document): The document the page belongs to.
+        page_idx (int): The 0-based page index.
+        loaded_pages (dict[int, fitz.Page]): Page index -> page, filled lazily.
+        
+    Returns:
+        fitz.Page: The loaded page.
+    """
+    if page_idx not in loaded_pages:
+        loaded_pages[page_idx] = doc.load_page(page_idx)
+    return loaded_pages[page_idx]
+
+def _iter_by_distance(old_page_number, doc_pages):
+    """
+    Yields every page index of the document, nearest to the original page first
+    (old_page_number, old_page_number-1, old_page_number+1, ...), so the local
+    window is always visited before the rest of the document.
+    
+    Args:
+        old_page_number (int): The 0-based page index of the original annotation.
+        doc_pages (int): Number of pages in the document.
+    """
+    if 0 <= old_page_number < doc_pages:
+        yield old_page_number
+    for distance in range(1, max(old_page_number + 1, doc_pages - old_page_number)):
+        if 0 <= old_page_number - distance < doc_pages:
+            yield old_page_number - distance
+        if 0 <= old_page_number + distance < doc_pages:
+            yield old_page_number + distance
+
+def _scan_page(all_page_words, page_idx, text_to_find, n_words, cutoff):
+    """
+    Finds the best sliding window of words on a single page.
+    
+    Args:
+        all_page_words (list[list[tuple]]): The words of every page of the document.
+        page_idx (int): The 0-based page index to scan.
         text_to_find (str): The text to find.
+        n_words (int): Number of words in `text_to_find` (the window size).
+        cutoff (int): Highest edit distance still worth reporting.
+        
+    Returns:
+        (int, int, int): The distance, page index and start word index of the
+                         best window, or None if no window is within `cutoff`.
+    """
+    page_words = all_page_words[page_idx]
+    
+    if len(page_words) < n_words:
+        return None
+        
+    # join the page once and record where each word starts, so every window
+    # is a single slice of that string instead of a new join
+    joined = " ".join(w[4] for w in page_words)
+    starts = [0]
+    for w in page_words:
+        starts.append(starts[-1] + len(w[4]) + 1)
+    
+    # Use a sliding window to check word combinations in nearby pages
+    candidates = [joined[starts[i] : starts[i + n_words] - 1] for i in range(len(page_words) - n_words + 1)]
+    
+    # score all windows of the page in one call
+    # (rapidfuzz rejects windows by length difference before computing the distance)
+    # keep passing RFL.distance itself, not a wrapper: extractOne then builds the
+    # bit-parallel (Myers) pattern of text_to_find once and reuses it for every window,
+    # which is one machine word per row for texts up to 64 chars
+    match = process.extractOne(text_to_find, candidates, scorer=RFL.distance, score_cutoff=cutoff)
+    if match is None:
+        return None
+    
+    _, distance, i = match
+    return distance, page_idx, i
+
+def find_best_fuzzy_match_in_pages(all_page_words, text_to_find, n_words, threshold_ratio, base_allowance, page_indices):
+    """
+    Searches a subset of pages in the document for the "best" fuzzy match.
+    
+    Args:
+        all_page_words (list[list[tuple]]): The words of every page of the document.
+        text_to_find (str): The text to find, whitespace-normalized.
+        n_words (int): Number of words in `text_to_find`.
         threshold_ratio (float): Allowed percentage difference (e.g., 0.3 for 30%).
         base_allowance (int): A small base number of allowed edits.
         page_indices (list[int]): A list of 0-based page indices to search.
         
     Returns:
-        (fitz.Page, list[fitz.Quad]): The page and list of quads for the best
-                                      match below the threshold, or (None, None).
+        (int, list[fitz.Quad]): The page index and list of quads for the best
+                                match below the threshold, or (None, None).
     """
-    words_to_find = text_to_find.split()
-    n_words = len(words_to_find)
     if n_words == 0:
         return None, None
         
-    best_match = {'page': None, 'quads': [], 'distance': float('inf')}
-    
     # calculate the allowed edit distance using the configurable parameters
     allowed_distance = int(len(text_to_find) * threshold_ratio) + base_allowance
     
+    # no distance can be negative, so nothing can match (and rapidfuzz rejects such a cutoff)
+    if allowed_distance < 0:
+        return None, None
+    
+    best_match = None
+    cutoff = allowed_distance
+    
     for page_idx in page_indices:
-        # Load the page from the document using its index
-        page = doc.load_page(page_idx)
-        page_words = page.get_text("words") 
-        
-        if len(page_words) < n_words:
+        result = _scan_page(all_page_words, page_idx, text_to_find, n_words, cutoff)
+        if result is None:
             continue
-            
-        # Use a sliding window to check word combinations in nearby pages
-        for i in range(len(page_words) - n_words + 1):
-            window_words_info = page_words[i : i + n_words]
-            candidate_text = " ".join([w[4] for w in window_words_info])
-            
-            # check with Levenshtein distance
-            distance = Levenshtein.distance(text_to_find, candidate_text)
-            
-            if distance < best_match['distance']:
-                best_match['distance'] = distance
-                best_match['page'] = page
-                best_match['quads'] = [fitz.Rect(w[:4]).quad for w in window_words_info]
-
-    # only return the match if it's within the reasonable distance threshold
-    if best_match['distance'] <= allowed_distance:
-        return best_match['page'], best_match['quads']
         
-    return None, None
+        best_match = result
+        # an exact window was found, nothing can beat it
+        if best_match[0] == 0:
+            break
+        # only look for strictly better windows, so the first page in `page_indices` order wins ties
+        cutoff = best_match[0] - 1
+    
+    if best_match is None:
+        return None, None
+    
+    distance, page_idx, i = best_match
+    page_words = all_page_words[page_idx]
+    return page_idx, [fitz.Rect(w[:4]).quad for w in page_words[i : i + n_words]]
 
-def find_text_occurrence(doc, text, fuzzy_ratio, fuzzy_allowance, old_page_number):
+def find_text_occurrence(doc, text, n_words, fuzzy_ratio, fuzzy_allowance, old_page_number, all_page_words, all_page_bytes_lower, loaded_pages):
     """
     Searches the document for a given text using a prioritized search order:
-    1. Local Exact Match
-    2. Full Document Exact Match
-    3. Local Fuzzy Match
-    4. Full Document Fuzzy Match
+    1. Exact Match (nearest pages first)
+    2. Local Fuzzy Match
+    3. Fuzzy Match on all candidate pages
+    
+    Only pages the caller would accept are searched: up to MAX_PAGE_DISTANCE pages
+    away from the original page, and up to FUZZY_MAX_PAGE_DISTANCE for fuzzy matches.
     
     Args:
         doc (fitz.Document): The document to search.
-        text (str): The text to find.
+        text (str): The text to find. Must already be whitespace-normalized
+                    (" ".join(text.split())), as done by the caller.
+        n_words (int): Number of words in `text`.
         fuzzy_ratio (float): The configurable fuzzy threshold ratio.
         fuzzy_allowance (int): The configurable fuzzy threshold allowance.
         old_page_number (int): The 0-based page index of the original annotation.
+        all_page_words (list[list[tuple]]): The words of every page of `doc`.
+        all_page_bytes_lower (list[bytes]): The whitespace-normalized, lower-cased,
+                                            UTF-8 encoded text of every page of `doc`,
+                                            extracted with SEARCH_FLAGS.
+        loaded_pages (dict[int, fitz.Page]): Shared page index -> page cache.
         
     Returns:
         (fitz.Page, list[fitz.Quad], str): The page, list of quads, and
                                             match type ("exact", "fuzzy", "none").
     """
-    search_text = " ".join(text.split())  # Normalize whitespace
-    if not search_text:
+    if not text:
         return None, None, "none"
         
     doc_pages = doc.page_count
@@ -97,47 +203,134 @@ def find_text_occurrence(doc, text, fuzzy_ratio, fuzzy_allowance, old_page_numbe
     # calculate start and end page indices (0-based) for the local window
     start_page_idx = max(0, old_page_number - LOCAL_PAGE_WINDOW)
     end_page_idx = min(doc_pages, old_page_number + LOCAL_PAGE_WINDOW + 1) # +1 for slicing end
-    local_page_indices = list(range(start_page_idx, end_page_idx))
-    all_page_indices = list(range(doc_pages))
-
-    # --- 1. Local Exact Match Search ---
-    for page_idx in local_page_indices:
-        page = doc.load_page(page_idx)
-        quads = page.search_for(search_text, quads=True)
-        if quads:
-            return page, quads, "exact"
+    
+    # matches farther than this are rejected by the caller anyway, so don't search there
+    fuzzy_max_distance = min(MAX_PAGE_DISTANCE, FUZZY_MAX_PAGE_DISTANCE)
+    candidate_indices = [i for i in range(doc_pages) if abs(i - old_page_number) <= fuzzy_max_distance]
+    local_page_indices = [i for i in range(start_page_idx, end_page_idx) if abs(i - old_page_number) <= fuzzy_max_distance]
+    
+    # search_for is case-insensitive, so a plain substring check on the lower-cased
+    # page text tells cheaply whether it's worth running it on a page; as UTF-8 bytes
+    # it stays one byte per char for latin text and the check takes the memchr fast path
+    needle_lower = text.lower().encode("utf-8")
 
-    # --- 2. Full Document Exact Match Search (Fallback) ---
-    # Iterating all pages ensures we don't miss anything. The page distance check handles rejections later.
-    for page_idx in all_page_indices:
-        page = doc.load_page(page_idx)
-        quads = page.search_for(search_text, quads=True)
+    # --- 1. Exact Match Search ---
+    for page_idx in _iter_by_distance(old_page_number, doc_pages):
+        # pages come nearest first, so every remaining one is too far as well
+        if abs(page_idx - old_page_number) > MAX_PAGE_DISTANCE:
+            break
+        if needle_lower not in all_page_bytes_lower[page_idx]:
+            continue
+        page = get_page(doc, page_idx, loaded_pages)
+        quads = page.search_for(text, quads=True, flags=SEARCH_FLAGS)
         if quads:
             return page, quads, "exact"
             
-    # --- 3. Local Fuzzy Match Search ---
-    page, quads = find_best_fuzzy_match_in_pages(doc, search_text, fuzzy_ratio, fuzzy_allowance, local_page_indices)
-    if page and quads:
-        return page, quads, "fuzzy"
-
-    # --- 4. Full Document Fuzzy Match Search (Fallback) ---
-    page, quads = find_best_fuzzy_match_in_pages(doc, search_text, fuzzy_ratio, fuzzy_allowance, all_page_indices)
-    if page and quads:
-        return page, quads, "fuzzy"
+    # --- 2. Local Fuzzy Match Search ---
+    page_idx, quads = find_best_fuzzy_match_in_pages(all_page_words, text, n_words, fuzzy_ratio, fuzzy_allowance, local_page_indices)
+    if page_idx is not None and quads:
+        return get_page(doc, page_idx, loaded_pages), quads, "fuzzy"
+
+    # --- 3. Candidate Pages Fuzzy Match Search (Fallback) ---
+    # skipped when the local window already covered every candidate page
+    if candidate_indices != local_page_indices:
+        page_idx, quads = find_best_fuzzy_match_in_pages(all_page_words, text, n_words, fuzzy_ratio, fuzzy_allowance, candidate_indices)
+        if page_idx is not None and quads:
+            return get_page(doc, page_idx, loaded_pages), quads, "fuzzy"
             
     return None, None, "none"
 
-def transfer_annotations(old_pdf_path, new_pdf_path, output_pdf_path, fuzzy_ratio, fuzzy_allowance):
+def flush_log(log_lines):
+    """
+    Writes the buffered log lines to the console with a single call and empties the buffer.
+    
+    Args:
+        log_lines (list[str]): The buffered lines, without trailing newlines.
+    """
+    if log_lines:
+        sys.stdout.write("\n".join(log_lines) + "\n")
+        log_lines.clear()
+
+def _init_match_worker(old_pdf_path, new_pdf_path, all_page_words, all_page_bytes_lower, fuzzy_ratio, fuzzy_allowance):
+    """
+    Initializes a matching worker process: opens both PDFs read-only and keeps
+    the page indexes of the new document, which are sent once per worker.
+    """
+    _worker["old_doc"] = fitz.open(old_pdf_path)
+    _worker["new_doc"] = fitz.open(new_pdf_path)
+    _worker["all_page_words"] = all_page_words
+    _worker["all_page_bytes_lower"] = all_page_bytes_lower
+    _worker["fuzzy_ratio"] = fuzzy_ratio
+    _worker["fuzzy_allowance"] = fuzzy_allowance
+    _worker["loaded_pages"] = {}
+
+def _match_page_annotations(page_number):
+    """
+    Finds where the markup annotations of one old page go in the new document.
+    Runs in a worker process, so it only returns picklable results.
+    
+    Args:
+        page_number (int): The 0-based index of the page in the old document.
+        
+    Returns:
+        list: One entry per annotation of the page, in order. None for
+              unsupported annotation types, otherwise a tuple
+              (target_text, new_page_idx, quads, match_type).
+    """
+    # read the worker state into locals once, not per annotation
+    new_doc = _worker["new_doc"]
+    fuzzy_ratio = _worker["fuzzy_ratio"]
+    fuzzy_allowance = _worker["fuzzy_allowance"]
+    all_page_words = _worker["all_page_words"]
+    all_page_bytes_lower = _worker["all_page_bytes_lower"]
+    loaded_pages = _worker["loaded_pages"]
+    
+    old_page = _worker["old_doc"].load_page(page_number)
+    matches = []
+    for annot in old_page.annots():
+        if annot.type[0] not in ADDERS:
+            matches.append(None)
+            continue
+        
+        # get the text covered by the annotation
+        words_to_find = old_page.get_text("text", clip=annot.rect).split()
+        
+        # normalize whitespace (no new lines or multitple spaces), once for all search passes
+        target_text = " ".join(words_to_find)
+        
+        if not target_text:
+            matches.append((target_text, None, None, "none"))
+            continue
+        
+        # search for this text in the new document, passing the old page index as a base
+        new_page, quads, match_type = find_text_occurrence(
+            new_doc, target_text, len(words_to_find), fuzzy_ratio, fuzzy_allowance, page_number,
+            all_page_words, all_page_bytes_lower, loaded_pages
+        )
+        new_page_idx = new_page.number if new_page is not None else None
+        matches.append((target_text, new_page_idx, quads, match_type))
+    return matches
+
+def transfer_annotations(old_pdf_path, new_pdf_path, output_pdf_path, fuzzy_ratio, fuzzy_allowance, rewrite=False):
     """
     Transfers annotations from an old PDF to a new version based on text content,
     and preserves the Table of Contents (Outline/Bookmarks).
     
+    By default the annotations are appended with an incremental save to a copy of
+    the new PDF, which then replaces the output file. With `rewrite`, or when the new PDF can't
+    be saved incrementally, the whole document is rebuilt and re-serialized.
+    
     Supports: Highlight, Underline, Squiggly, and their associated reply comments.
     """
     
     print(f"Opening old PDF: {old_pdf_path}")
     print(f"Opening new PDF: {new_pdf_path}")
     
+    # the old PDF is read until the end, and the output is written over from the start
+    if os.path.exists(output_pdf_path) and os.path.samefile(old_pdf_path, output_pdf_path):
+        print(f"Error: Output path must not be the old PDF: {output_pdf_path}")
+        return
+    
     try:
         old_doc = fitz.open(old_pdf_path)
         new_doc = fitz.open(new_pdf_path)
@@ -147,213 +340,271 @@ def transfer_annotations(old_pdf_path, new_pdf_path, output_pdf_path, fuzzy_rati
 
     # get the TOC structure from the new PDF before its file handle is closed.
     toc_data = new_doc.get_toc()
-    output_doc = fitz.open()
-    output_doc.insert_pdf(new_doc)
-    new_doc.close() # Close the source document handle
-    
-    print(f"Created editable copy in memory.")
-
-    # annotation supported by this script (Text Markups)
-    markup_types = [
-        fitz.PDF_ANNOT_HIGHLIGHT,
-        fitz.PDF_ANNOT_UNDERLINE,
-        fitz.PDF_ANNOT_SQUIGGLY
-    ]
-    
-    transferred_count = 0
-    transferred_fuzzy_count = 0
-    failed_count = 0
-    unsupported_count = 0
-    failed_annotations = []
-    
-    # map to store newly created annotations, mapping old_xref -> new_annot
-    new_annot_map = {}  
-
-    # transfer text markup annotations ---
-    print("\n--- Pass 1: Transferring Text Markups (Highlights, Underlines, etc.) ---")
-
-    for old_page in old_doc:
-        old_page_number = old_page.number # 0-based index
-        for annot in old_page.annots():
-            if annot.type[0] not in markup_types:
-                unsupported_count += 1
-                continue
+    
+    # an incremental save only appends the new annotations instead of rewriting every page,
+    # but it isn't possible if PyMuPDF had to repair the file when opening it
+    incremental = not rewrite and new_doc.can_save_incrementally()
+    
+    # with an incremental save, the annotations are added to a temporary copy next to the
+    # output, which only replaces the output once it was saved successfully
+    temp_pdf_path = None
+    
+    if incremental:
+        new_doc.close() # Close the source document handle
+        try:
+            fd, temp_pdf_path = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(os.path.abspath(output_pdf_path)))
+            os.close(fd)
+            shutil.copy(new_pdf_path, temp_pdf_path)
+            output_doc = fitz.open(temp_pdf_path)
+        except Exception as e:
+            print(f"Error creating output file {output_pdf_path}: {e}")
+            old_doc.close()
+            if temp_pdf_path and os.path.exists(temp_pdf_path):
+                os.remove(temp_pdf_path)
+            return
+        
+        print(f"Created editable copy at: {temp_pdf_path}")
+    else:
+        output_doc = fitz.open()
+        output_doc.insert_pdf(new_doc)
+        new_doc.close() # Close the source document handle
+        
+        print(f"Created editable copy in memory.")
 
-            # get the text covered by the annotation
-            target_text = old_page.get_text("text", clip=annot.rect).strip()
-            
-            # normalize whitespace (no new lines or multitple spaces)
-            target_text = " ".join(target_text.split())
+    try:
+        transferred_count = 0
+        transferred_fuzzy_count = 0
+        failed_count = 0
+        unsupported_count = 0
+        failed_annotations = []
+    
+        # map to store newly created annotations, mapping old_xref -> new_annot
+        new_annot_map = {}  
+    
+        # sticky notes replying to another annotation, collected during Pass 1 as (old_page, annot)
+        reply_candidates = []
 
-            if not target_text:
-                print(f"{RED}  [FAIL] Page {old_page_number+1}: Skipping empty annotation.{ENDC}")
-                failed_annotations.append((old_page_number + 1, "Empty Annotation Text"))
-                failed_count += 1
-                continue
+        # extract the words of every page once, so they are shared by all annotations
+        all_page_words = []
+        all_page_bytes_lower = []
+        for page in output_doc:
+            all_page_words.append(page.get_text("words"))
+            # the exact search prefilter must see the text the way search_for does, or it
+            # would skip pages where the match spans a word hyphenated at a line end
+            page_text = page.get_text("text", flags=SEARCH_FLAGS)
+            all_page_bytes_lower.append(" ".join(page_text.split()).lower().encode("utf-8"))
+        # pages receiving new annotations are loaded at most once
+        loaded_pages = {}
 
-            # search for this text in the new document, passing the old page index as a base
-            new_page, quads, match_type = find_text_occurrence(output_doc, target_text, fuzzy_ratio, fuzzy_allowance, old_page_number)
-            
-            if match_type != "none":
-                page_distance = abs(new_page.number - old_page_number)
+        # per-annotation messages are buffered and written in batches of LOG_FLUSH_LINES
+        log_lines = []
+
+        # transfer text markup annotations ---
+        print("\n--- Pass 1: Transferring Text Markups (Highlights, Underlines, etc.) ---")
+
+        # match the annotations of each old page in worker processes; only the main
+        # process edits output_doc, applying the results page by page in order
+        # no more workers than old pages, each one has to reopen both PDFs and load the indexes
+        with ProcessPoolExecutor(
+            max_workers=min(os.cpu_count() or 1, max(old_doc.page_count, 1)),
+            initializer=_init_match_worker,
+            initargs=(old_pdf_path, new_pdf_path, all_page_words, all_page_bytes_lower, fuzzy_ratio, fuzzy_allowance)
+        ) as executor:
+            page_matches_iter = executor.map(_match_page_annotations, range(old_doc.page_count))
+            for old_page, page_matches in zip(old_doc, page_matches_iter):
+                old_page_number = old_page.number # 0-based index
+                for annot, page_match in zip(old_page.annots(), page_matches):
+                    if len(log_lines) >= LOG_FLUSH_LINES:
+                        flush_log(log_lines)
                 
-                # reasonable page distance check
-                if page_distance > MAX_PAGE_DISTANCE:
-                    reason = f"Too far away (distance exceeds {MAX_PAGE_DISTANCE} pages)"
-                    color = RED
-                    
-                    # log an error for transfers that are wildly distant
-                    print(f"{color}  [FAIL] Page {old_page_number+1} -> Rejected {match_type.capitalize()} Match (New Page {new_page.number+1}): {reason}. '{target_text[:40]}...'{ENDC}")
-                    failed_annotations.append((old_page_number + 1, target_text))
-                    failed_count += 1
-                    continue # skip this annotation
-
-                # optional stricter check if it was a fuzzy match
-                if match_type == "fuzzy" and page_distance > FUZZY_MAX_PAGE_DISTANCE:  
-                    # Use a stricter 5-page threshold for fuzzy matches to ensure context similarity
-                    reason = "Too far away for a safe fuzzy match (distance exceeds 5 pages)"
-                    color = RED
-                    print(f"{color}  [FAIL] Page {old_page_number+1} -> Rejected Fuzzy Match (New Page {new_page.number+1}): {reason}. '{target_text[:40]}...'{ENDC}")
-                    failed_annotations.append((old_page_number + 1, target_text))
-                    failed_count += 1
-                    continue # skip this annotation
-
-                # found the text (either exact or fuzzy) and the page distance is reasonable.
-                new_annot = None
-                annot_type = annot.type[0]
+                    if annot.type[0] not in ADDERS:
+                        # check if it's a sticky note ('Text' annotation) replying to another annotation
+                        if annot.type[0] == fitz.PDF_ANNOT_TEXT and annot.irt_xref != 0:
+                            reply_candidates.append((old_page, annot))
+                        unsupported_count += 1
+                        continue
+
+                    target_text, new_page_idx, quads, match_type = page_match
+
+                    if not target_text:
+                        log_lines.append(f"{RED}  [FAIL] Page {old_page_number+1}: Skipping empty annotation.{ENDC}")
+                        failed_annotations.append((old_page_number + 1, "Empty Annotation Text"))
+                        failed_count += 1
+                        continue
+
+                    if match_type != "none":
+                        new_page = get_page(output_doc, new_page_idx, loaded_pages)
+                        page_distance = abs(new_page.number - old_page_number)
                 
-                if annot_type == fitz.PDF_ANNOT_HIGHLIGHT:
-                    new_annot = new_page.add_highlight_annot(quads)
-                elif annot_type == fitz.PDF_ANNOT_UNDERLINE:
-                    new_annot = new_page.add_underline_annot(quads)
-                elif annot_type == fitz.PDF_ANNOT_SQUIGGLY:
-                    new_annot = new_page.add_squiggly_annot(quads)
+                        # reasonable page distance check
+                        if page_distance > MAX_PAGE_DISTANCE:
+                            reason = f"Too far away (distance exceeds {MAX_PAGE_DISTANCE} pages)"
+                            color = RED
+                    
+                            # log an error for transfers that are wildly distant
+                            log_lines.append(f"{color}  [FAIL] Page {old_page_number+1} -> Rejected {match_type.capitalize()} Match (New Page {new_page.number+1}): {reason}. '{target_text[:40]}...'{ENDC}")
+                            failed_annotations.append((old_page_number + 1, target_text))
+                            failed_count += 1
+                            continue # skip this annotation
+
+                        # optional stricter check if it was a fuzzy match
+                        if match_type == "fuzzy" and page_distance > FUZZY_MAX_PAGE_DISTANCE:  
+                            # Use a stricter 5-page threshold for fuzzy matches to ensure context similarity
+                            reason = "Too far away for a safe fuzzy match (distance exceeds 5 pages)"
+                            color = RED
+                            log_lines.append(f"{color}  [FAIL] Page {old_page_number+1} -> Rejected Fuzzy Match (New Page {new_page.number+1}): {reason}. '{target_text[:40]}...'{ENDC}")
+                            failed_annotations.append((old_page_number + 1, target_text))
+                            failed_count += 1
+                            continue # skip this annotation
+
+                        # found the text (either exact or fuzzy) and the page distance is reasonable.
+                        new_annot = ADDERS[annot.type[0]](new_page, quads)
                 
-                if new_annot:
-                    old_info = annot.info
+                        if new_annot:
+                            old_info = annot.info
                     
-                    if match_type == "exact":
-                        if annot.colors.get("stroke"):
-                            new_annot.set_colors(stroke=annot.colors["stroke"])
+                            if match_type == "exact":
+                                if annot.colors.get("stroke"):
+                                    new_annot.set_colors(stroke=annot.colors["stroke"])
                         
-                        new_annot.set_info(
-                            content=old_info.get("content", ""),
-                            title=old_info.get("title", "Note")
-                        )
-                        transferred_count += 1
-                        print(f"  [OK-EXACT] Page {old_page_number+1} -> {new_page.number+1}: Transferred '{target_text[:40]}...'{ENDC}")
+                                new_annot.set_info(
+                                    content=old_info.get("content", ""),
+                                    title=old_info.get("title", "Note")
+                                )
+                                transferred_count += 1
+                                log_lines.append(f"  [OK-EXACT] Page {old_page_number+1} -> {new_page.number+1}: Transferred '{target_text[:40]}...'{ENDC}")
                         
-                    elif match_type == "fuzzy":                      
-                        old_content = old_info.get("content", "")
-                        # include the original text and distance in the note for review
-                        fuzzy_note = f"[FUZZY MATCH] Page distance: {page_distance}. Original text:\n'{target_text}'"
-                        new_content = f"{fuzzy_note}\n\n{old_content}" if old_content else fuzzy_note
+                            elif match_type == "fuzzy":                      
+                                old_content = old_info.get("content", "")
+                                # include the original text and distance in the note for review
+                                fuzzy_note = f"[FUZZY MATCH] Page distance: {page_distance}. Original text:\n'{target_text}'"
+                                new_content = f"{fuzzy_note}\n\n{old_content}" if old_content else fuzzy_note
                         
-                        new_annot.set_info(
-                            content=new_content,
-                            title=old_info.get("title", "Note (Fuzzy)")
-                        )
-                        transferred_fuzzy_count += 1
-                        print(f"{BLUE}  [OK-FUZZY] Page {old_page_number+1} -> {new_page.number+1}: Transferred (Fuzzy) '{target_text[:40]}...'{ENDC}")
+                                new_annot.set_info(
+                                    content=new_content,
+                                    title=old_info.get("title", "Note (Fuzzy)")
+                                )
+                                transferred_fuzzy_count += 1
+                                log_lines.append(f"{BLUE}  [OK-FUZZY] Page {old_page_number+1} -> {new_page.number+1}: Transferred (Fuzzy) '{target_text[:40]}...'{ENDC}")
                     
-                    new_annot.update()  # apply the changes
+                            new_annot.update()  # apply the changes
                     
-                    # store in map for replies
-                    new_annot_map[annot.xref] = new_annot
+                            # store in map for replies
+                            new_annot_map[annot.xref] = new_annot
                 
+                    else:
+                        # could not find the text in the new document
+                        failed_annotations.append((old_page_number + 1, target_text))
+                        failed_count += 1
+                        log_lines.append(f"{RED}  [FAIL] Page {old_page_number+1}: Could not find text: '{target_text[:40]}...'{ENDC}")
+
+        # check for sticky notes replies
+        log_lines.append("\n--- Pass 2: Transferring Replies (Sticky Notes) ---")
+        for old_page, annot in reply_candidates:
+            if len(log_lines) >= LOG_FLUSH_LINES:
+                flush_log(log_lines)
+        
+            # check if it's a reply to an annotation we just transferred
+            if annot.irt_xref in new_annot_map:
+                parent_annot = new_annot_map[annot.irt_xref]
+                new_page = parent_annot.parent
+            
+                # get content from old note
+                old_info = annot.info
+                content = old_info.get("content", "Reply")
+                title = old_info.get("title", "Reply")
+
+                # place the new sticky note near the top-right of its parent
+                tr = parent_annot.rect.tr  # top-right
+                point = fitz.Point(tr.x + 5, tr.y - 2)  # offset slightly
+            
+                new_note = new_page.add_text_annot(point, content)
+                new_note.set_info(content=content, title=title)
+                new_note.update()
+            
+                transferred_count += 1
+                log_lines.append(f"  [OK] Page {new_page.number+1}: Transferred reply: '{content[:40]}...'{ENDC}")
             else:
-                # could not find the text in the new document
-                failed_annotations.append((old_page_number + 1, target_text))
-                failed_count += 1
-                print(f"{RED}  [FAIL] Page {old_page_number+1}: Could not find text: '{target_text[:40]}...'{ENDC}")
-
-    # check for sticky notes replies
-    print("\n--- Pass 2: Transferring Replies (Sticky Notes) ---")
-    for old_page in old_doc:
-        for annot in old_page.annots():
-            # check if it's a sticky note ('Text' annotation)
-            if annot.type[0] == fitz.PDF_ANNOT_TEXT:
-                # check if it's a reply to an annotation we just transferred
-                if annot.irt_xref in new_annot_map:
-                    parent_annot = new_annot_map[annot.irt_xref]
-                    new_page = parent_annot.page
-                    
-                    # get content from old note
-                    old_info = annot.info
-                    content = old_info.get("content", "Reply")
-                    title = old_info.get("title", "Reply")
-
-                    # place the new sticky note near the top-right of its parent
-                    tr = parent_annot.rect.tr  # top-right
-                    point = fitz.Point(tr.x + 5, tr.y - 2)  # offset slightly
-                    
-                    new_note = new_page.add_text_annot(point, content)
-                    new_note.set_info(content=content, title=title)
-                    new_note.update()
-                    
-                    transferred_count += 1
-                    print(f"  [OK] Page {new_page.number+1}: Transferred reply: '{content[:40]}...'{ENDC}")
-                else:
-                    # standalone sticky note, or parent wasn't transferred. Not supported, skip.
-                    unsupported_count += 1
+                # parent wasn't transferred. Not supported, skip.
+                unsupported_count += 1
 
-    # final save
-    try:
-        # transfer TOC
-        if toc_data:
-             output_doc.set_toc(toc_data)
+        flush_log(log_lines)
 
-        # save the final document with all new annotations
-        output_doc.save(output_pdf_path, garbage=3, deflate=True)
-        
-        print("\n--- Transfer Complete ---")
-        print(f"Successfully transferred (Exact): {transferred_count}")
-        print(f"Successfully transferred (Fuzzy, Blue): {transferred_fuzzy_count}")
-        print(f"Failed (Text not found/Too far): {failed_count}")
-        print(f"Skipped (unsupported type): {unsupported_count}")
-        print(f"\nFinal annotated file saved to: {output_pdf_path}")
-        
-        if failed_annotations:
-            print(f"\n{RED}--- Failed Annotations Summary ({len(failed_annotations)} total) ---{ENDC}")
-            for page, text in failed_annotations:
-                # Print failed annotations in red
-                print(f"{RED}Original Page {page}: '{text[:80]}...'{ENDC}")
+        # final save
+        try:
+            if incremental:
+                # the copy already has the TOC, only append the new annotations
+                output_doc.save(temp_pdf_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+                output_doc.close()
+                # only now overwrite the output, so a failed transfer leaves it untouched
+                os.replace(temp_pdf_path, output_pdf_path)
+            else:
+                # transfer TOC
+                if toc_data:
+                     output_doc.set_toc(toc_data)
 
-    except Exception as e:
-        print(f"Error saving final file: {e}")
+                # save the final document with all new annotations; only drop unused objects,
+                # skipping the costlier search for duplicate objects
+                output_doc.save(output_pdf_path, garbage=1, deflate=True)
+            
+            print("\n--- Transfer Complete ---")
+            print(f"Successfully transferred (Exact): {transferred_count}")
+            print(f"Successfully transferred (Fuzzy, Blue): {transferred_fuzzy_count}")
+            print(f"Failed (Text not found/Too far): {failed_count}")
+            print(f"Skipped (unsupported type): {unsupported_count}")
+            print(f"\nFinal annotated file saved to: {output_pdf_path}")
+            
+            if failed_annotations:
+                print(f"\n{RED}--- Failed Annotations Summary ({len(failed_annotations)} total) ---{ENDC}")
+                # Print failed annotations in red, all at once
+                flush_log([f"{RED}Original Page {page}: '{text[:80]}...'{ENDC}" for page, text in failed_annotations])
+
+        except Exception as e:
+            print(f"Error saving final file: {e}")
     finally:
         old_doc.close()
-        if 'output_doc' in locals():
+        if not output_doc.is_closed:
             output_doc.close()
+        # the transfer or the save failed: don't leave the unannotated copy behind
+        if temp_pdf_path and os.path.exists(temp_pdf_path):
+            os.remove(temp_pdf_path)
 
 def main():
-    if len(sys.argv) < 4 or len(sys.argv) > 6:
-        print("Usage: python main.py <old_pdf> <new_pdf> <output_pdf> [fuzzy_ratio] [base_allowance]")
+    args = sys.argv[1:]
+    
+    # optional flag to rebuild and fully re-serialize the output instead of saving incrementally
+    rewrite = "--rewrite" in args
+    if rewrite:
+        args.remove("--rewrite")
+    
+    if len(args) < 3 or len(args) > 5:
+        print("Usage: python main.py <old_pdf> <new_pdf> <output_pdf> [fuzzy_ratio] [base_allowance] [--rewrite]")
         print("Example 1 (Default Fuzzy): python main.py v1.pdf v2.pdf v2_with_annots.pdf")
         print("Example 2 (Custom Fuzzy): python main.py v1.pdf v2.pdf v2_with_annots.pdf 0.4 5")
+        print("Example 3 (Full Rewrite): python main.py v1.pdf v2.pdf v2_with_annots.pdf --rewrite")
         sys.exit(1)
         
-    old_pdf_path = sys.argv[1]
-    new_pdf_path = sys.argv[2]
-    output_pdf_path = sys.argv[3]
+    old_pdf_path = args[0]
+    new_pdf_path = args[1]
+    output_pdf_path = args[2]
     
     # default fuzzy parameters
     ratio = 0.3
     allowance = 5
     
     # Parse optional fuzzy ratio
-    if len(sys.argv) >= 5:
+    if len(args) >= 4:
         try:
-            ratio = float(sys.argv[4])
+            ratio = float(args[3])
         except ValueError:
-            print(f"Warning: Invalid fuzzy ratio '{sys.argv[4]}'. Using default {ratio}.")
+            print(f"Warning: Invalid fuzzy ratio '{args[3]}'. Using default {ratio}.")
     
     # Parse optional base allowance
-    if len(sys.argv) == 6:
+    if len(args) == 5:
         try:
-            allowance = int(sys.argv[5])
+            allowance = int(args[4])
         except ValueError:
-            print(f"Warning: Invalid base allowance '{sys.argv[5]}'. Using default {allowance}.")
+            print(f"Warning: Invalid base allowance '{args[4]}'. Using default {allowance}.")
             
     if not os.path.exists(old_pdf_path):
         print(f"Error: File not found at {old_pdf_path}")
@@ -372,7 +623,7 @@ def main():
   \\_/_|  \\__,_|_| |_|___/_| \\___|_|    \\_|   |___/ \\_|     \\_| |_/_| |_|_| |_|\\___/ \\__\\__,_|\\__|_|\\___/|_| |_|___/ 
 """
     )
-    transfer_annotations(old_pdf_path, new_pdf_path, output_pdf_path, ratio, allowance)
+    transfer_annotations(old_pdf_path, new_pdf_path, output_pdf_path, ratio, allowance, rewrite)
 
 if __name__ == "__main__":
     main()